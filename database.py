@@ -15,7 +15,18 @@ if not DATABASE_URL:
 
 # Create the engine instance once when the app starts.
 # This acts like a cache, as the code only runs one time.
-engine = create_engine(DATABASE_URL, pool_size=5, max_overflow=10)
+# Pool sized for concurrent /query requests, each holding a connection for
+# validation and then the data fetch. LIFO reuses the most recently used
+# connections, and recycling closes them before server-side idle timeouts.
+# Pre-ping is off to avoid an extra round-trip on every checkout.
+engine = create_engine(
+    DATABASE_URL,
+    pool_size=min(20, (os.cpu_count() or 4) * 2),
+    max_overflow=20,
+    pool_recycle=1800,
+    pool_pre_ping=False,
+    pool_use_lifo=True,
+)
 
 def get_engine():
     """Returns the globally created engine instance."""
@@ -1,27 +1,61 @@
-import streamlit as st
+import asyncio
+import logging
 import pandas as pd
 from sqlalchemy import create_engine, text, inspect
 import os
 import re
 # Assuming prompt_logic.py exists with the necessary functions
-from prompt_logic import build_prompt_from_files, query_olama
+from prompt_logic import EXAMPLES_FILE, add_feedback_example, prepare_sql_prompt, query_olama
 import sqlparse
+from sqlparse.engine import grouping as sqlparse_grouping
+from sqlparse.exceptions import SQLParseError
 from sqlparse.sql import Function, Identifier, Parenthesis
 from sqlparse.tokens import Name, Keyword, Whitespace, Punctuation
 import time
 from sqlalchemy.exc import ProgrammingError
 from sqlalchemy import text
-from pathlib import Path
 from database import get_engine
+from sql_fixes import apply_postgres_fixes
 from sqlalchemy import inspect
+from sqlalchemy.engine.reflection import Inspector
 from cachetools import cached, TTLCache
 
+logger = logging.getLogger(__name__)
+
+# The app uses a single engine, so its dialect is resolved once for all dialect checks
+_DIALECT = get_engine().dialect
+_IS_POSTGRES = _DIALECT.name == 'postgresql'
+
+
+# Set USE_SQLPARSE_FIXER=1 to use the slower sqlparse-based rewriter instead
+USE_SQLPARSE_FIXER = os.getenv("USE_SQLPARSE_FIXER", "0").lower() in ("1", "true", "yes")
+
+# Bound sqlparse's grouping work so pathological LLM output can't stall the server.
+# Parses that exceed these raise SQLParseError. This needs sqlparse >= 0.6.0;
+# 0.5.x silently stops grouping instead, which would skip the fixes.
+sqlparse_grouping.MAX_GROUPING_DEPTH = 50
+sqlparse_grouping.MAX_GROUPING_TOKENS = 2000
 
 def fix_postgres_sql(sql: str) -> str:
+    """
+    Fixes common MySQL-style SQL issues for PostgreSQL with a lightweight
+    rewriter that tracks nested parentheses (see sql_fixes.py).
+    """
+    if USE_SQLPARSE_FIXER:
+        return _fix_postgres_sql_sqlparse(sql)
+    return apply_postgres_fixes(sql)
+
+
+def _fix_postgres_sql_sqlparse(sql: str) -> str:
     """
     Fixes common MySQL-style SQL issues for PostgreSQL using sqlparse.
+    Falls back to the regex pipeline if the statement is too large to parse.
     """
-    parsed = sqlparse.parse(sql)
+    try:
+        parsed = sqlparse.parse(sql)
+    except SQLParseError as e:
+        logger.warning(f"sqlparse grouping limit hit, using the lightweight fixer instead: {e}")
+        return apply_postgres_fixes(sql)
     if not parsed:
         return sql.strip()
     statement = parsed[0]
@@ -84,31 +118,100 @@ def fix_postgres_sql(sql: str) -> str:
     process_tokens(statement.tokens)
     return str(statement).strip()
 
-@cached(cache=TTLCache(maxsize=1, ttl=600))
+SCHEMA_CACHE_TTL_SECONDS = 600
+_schema_cache = TTLCache(maxsize=1, ttl=SCHEMA_CACHE_TTL_SECONDS)
+# The shared Inspector keeps SQLAlchemy's reflection cache between calls. It expires
+# with the schema summary, so a recomputed summary never reuses stale reflection data.
+_inspector_cache = TTLCache(maxsize=1, ttl=SCHEMA_CACHE_TTL_SECONDS)
+# Formatted "Table: ..." snippets keyed by (schema, table, columns hash)
+_table_snippet_cache: dict[tuple, str] = {}
+
+def _get_inspector(engine) -> Inspector:
+    """Returns the shared Inspector, creating it on first use and after it expires."""
+    inspector = _inspector_cache.get(engine.url)
+    if inspector is None:
+        inspector = _inspector_cache[engine.url] = inspect(engine)
+    return inspector
+
+def clear_reflection_cache():
+    """Drops all cached reflection data, so DDL changes show up before the TTL expires."""
+    _inspector_cache.clear()
+    _schema_cache.clear()
+    _table_snippet_cache.clear()
+
+# Pulls every column of every table in the given schemas in a single round-trip.
+# format_type() gives full type names, e.g. character varying(255), numeric(10,2),
+# enum type names and integer[], rather than information_schema's generic data_type.
+_COLUMNS_QUERY = text("""
+    SELECT n.nspname, c.relname, a.attname, pg_catalog.format_type(a.atttypid, a.atttypmod)
+    FROM pg_catalog.pg_attribute a
+    JOIN pg_catalog.pg_class c ON c.oid = a.attrelid
+    JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+    WHERE n.nspname = ANY(:schemas)
+      AND c.relkind IN ('r', 'p')
+      AND a.attnum > 0
+      AND NOT a.attisdropped
+    ORDER BY n.nspname, c.relname, a.attnum
+""")
+
+def _fetch_columns(engine, schemas: list[str]) -> dict[tuple[str, str], list[tuple[str, str]]]:
+    """Returns {(schema, table): [(column, type), ...]} using one catalog query."""
+    tables: dict[tuple[str, str], list[tuple[str, str]]] = {}
+    with engine.connect() as connection:
+        rows = connection.execute(_COLUMNS_QUERY, {"schemas": schemas})
+        for table_schema, table_name, column_name, column_type in rows:
+            tables.setdefault((table_schema, table_name), []).append((column_name, column_type))
+    return tables
+
+@cached(cache=_schema_cache)
 def get_db_schema(engine):
     """Returns a simplified schema summary for LLM prompts."""
     try:
-        inspector = inspect(engine)
-        schema_context = ""
         schemas = ['public'] # You could make this a parameter if needed
+
+        if _IS_POSTGRES:
+            tables = _fetch_columns(engine, schemas)
+            snippets: dict[tuple, str] = {}
+            for (schema, table), columns in tables.items():
+                key = (schema, table, hash(tuple(columns)))
+                snippet = _table_snippet_cache.get(key)
+                if snippet is None:
+                    # Only tables that are new or whose columns changed are re-formatted
+                    snippet = f"Table: {table}\n" + "\n".join(f"  - {name} ({col_type})" for name, col_type in columns)
+                snippets[key] = snippet
+            # Replace the cache contents so dropped or altered tables don't linger
+            _table_snippet_cache.clear()
+            _table_snippet_cache.update(snippets)
+            return "\n\n".join(snippets.values())
+
+        # Other dialects fall back to per-table reflection
+        inspector = _get_inspector(engine)
+        parts: list[str] = []
         for schema in schemas:
             tables = inspector.get_table_names(schema=schema)
             for table in tables:
-                schema_context += f"Table: {table}\n"
+                parts.append(f"Table: {table}\n")
                 columns = inspector.get_columns(table, schema=schema)
                 for col in columns:
-                    schema_context += f"  - {col['name']} ({col['type']})\n"
-                schema_context += "\n"
-        return schema_context.strip()
+                    parts.append(f"  - {col['name']} ({col['type']})\n")
+                parts.append("\n")
+        return "".join(parts).strip()
     except Exception as e:
-        # Instead of using st.error, we print the error to the server's console
-        # and re-raise the exception. The API endpoint will catch this and
-        # return a proper HTTP 500 error to the front-end.
-        print(f"CRITICAL: Error fetching database schema: {e}")
+        # Log the error on the server and re-raise the exception. The API
+        # endpoint will catch this and return a proper HTTP 500 error to the front-end.
+        logger.exception(f"Error fetching database schema: {e}")
         raise
 
-def is_query_valid(sql_query: str, engine) -> tuple[bool, str]:
-    """Checks if a SQL query is valid by asking the database to EXPLAIN it."""
+# Skipping cost estimation keeps the planner work to a minimum where supported
+_EXPLAIN_PREFIX = "EXPLAIN (VERBOSE FALSE, COSTS FALSE)" if _IS_POSTGRES else "EXPLAIN"
+
+def is_query_valid(sql_query: str, connection, explain_cache: dict | None = None) -> tuple[bool, str]:
+    """
+    Checks if a SQL query is valid by asking the database to EXPLAIN it.
+    The EXPLAIN runs inside a transaction that is always rolled back.
+    Pass an explain_cache dict to reuse outcomes for identical SQL within one
+    generation run; without it the database is always asked.
+    """
 
     clean_query = sql_query.strip().upper()
 
@@ -116,18 +219,38 @@ def is_query_valid(sql_query: str, engine) -> tuple[bool, str]:
     if not (clean_query.startswith('SELECT') or clean_query.startswith('WITH')):
         return False, "Validation failed: Only SELECT or CTE statements can be checked."
 
+    if explain_cache is not None and sql_query in explain_cache:
+        return explain_cache[sql_query]
+
+    transaction = connection.begin()
     try:
-        with engine.connect() as connection:
-            connection.execute(text(f"EXPLAIN {sql_query}"))
-        return True, "OK"
+        connection.execute(text(f"{_EXPLAIN_PREFIX} {sql_query}"))
+        result = (True, "OK")
     except ProgrammingError as e:
         # Return the original, cleaner error message from the database
-        return False, f"{e.orig}"
+        result = (False, f"{e.orig}")
     except Exception as e:
+        # Connection problems and the like may be transient, so they are not cached
         return False, f"An unexpected error occurred: {e}"
+    finally:
+        transaction.rollback()
+
+    if explain_cache is not None:
+        explain_cache[sql_query] = result
+    return result
+
+def validate_sql(engine, sql_query: str, explain_cache: dict | None = None) -> tuple[bool, str]:
+    """
+    Runs is_query_valid on a pooled connection that is checked out only for
+    this check. Blocking, so async callers should run it in a worker thread.
+    """
+    if explain_cache is not None and sql_query in explain_cache:
+        return explain_cache[sql_query]
+    with engine.connect() as connection:
+        return is_query_valid(sql_query, connection, explain_cache)
 
 
-def generate_and_validate_sql(
+async def generate_and_validate_sql(
     user_question: str,
     enhanced_schema: str,
     engine,
@@ -145,7 +268,7 @@ def generate_and_validate_sql(
 
     # Logic to handle a retry based on user feedback (previously in session_state)
     if previous_sql and user_feedback:
-        print("INFO: Re-generating query with user feedback.") # Server-side log
+        logger.info("Re-generating query with user feedback.")
         feedback_context = f"\n**User's Feedback on Why It Was Wrong:**\n{user_feedback}"
         
         base_prompt_instruction = f"""
@@ -160,19 +283,23 @@ Create a new, corrected PostgreSQL query. Return ONLY the final SQL.
 
     generated_sql = ""
     error_message = ""
+    # EXPLAIN outcomes for this run only, so the final check after an early stop is free.
+    # A connection is checked out per check rather than held while waiting on the LLM.
+    explain_results: dict[str, tuple[bool, str]] = {}
 
     # This loop is for automatic SYNTAX correction
     for attempt in range(max_syntax_retries + 1):
         prompt = ""
         if attempt == 0:
-            prompt = build_prompt_from_files(
+            prompt = await prepare_sql_prompt(
                 enhanced_schema,
-                Path("prompt_components/examples.txt"),
-                base_prompt_instruction
+                EXAMPLES_FILE,
+                base_prompt_instruction,
+                retrieval_question=user_question
             )
         else:
             # This is a syntax-fix retry
-            print(f"INFO: Query validation failed. Retrying syntax. (Attempt {attempt + 1})")
+            logger.info(f"Query validation failed. Retrying syntax. (Attempt {attempt + 1})")
             fix_instructions = f"""
 The previously generated SQL query failed with a syntax error.
 Analyze the schema, examples, user question, failed SQL, and the database error message.
@@ -181,25 +308,33 @@ Output ONLY the corrected, valid PostgreSQL query.
 **Failed SQL Query:** {generated_sql}
 **Database Error Message:** {error_message}
 """
-            prompt = build_prompt_from_files(
+            prompt = await prepare_sql_prompt(
                 enhanced_schema,
-                Path("prompt_components/examples.txt"),
-                base_prompt_instruction + "\n\n" + fix_instructions
+                EXAMPLES_FILE,
+                base_prompt_instruction + "\n\n" + fix_instructions,
+                retrieval_question=user_question
             )
 
-        generated_sql_raw = query_olama(prompt)
+        # Stop the stream as soon as the model has emitted a complete, valid statement.
+        # The final validation below is then answered from explain_results.
+        async def is_complete_statement(partial_output: str) -> bool:
+            candidate = fix_postgres_sql(clean_sql_output(partial_output))
+            is_valid, _ = await asyncio.to_thread(validate_sql, engine, candidate, explain_results)
+            return is_valid
+
+        generated_sql_raw = await query_olama(prompt, stop_when=is_complete_statement)
         cleaned_sql = clean_sql_output(generated_sql_raw)
         generated_sql = fix_postgres_sql(cleaned_sql)
 
-        is_valid, message = is_query_valid(generated_sql, engine)
+        is_valid, message = await asyncio.to_thread(validate_sql, engine, generated_sql, explain_results)
 
         if is_valid:
-            print("INFO: SQL query validated successfully.")
+            logger.info("SQL query validated successfully.")
             return generated_sql  # SUCCESS! The function ends here.
 
         # If not valid, store the error message and the loop will continue
         error_message = message
-        print(f"ERROR: Syntax Validation Error: {error_message}")
+        logger.error(f"Syntax Validation Error: {error_message}")
 
     # If the loop finishes without a 'return', it means all retries have failed.
     # We now raise a specific error instead of returning None.
@@ -208,6 +343,29 @@ Output ONLY the corrected, valid PostgreSQL query.
         f"Last database error: {error_message}"
     )
 
+def save_good_example(question: str, sql_query: str) -> bool:
+    """
+    Saves a query the user marked as helpful so it can be retrieved as a
+    few-shot example for similar questions. Returns True on success.
+    Raises ValueError if the SQL isn't a single valid SELECT/WITH statement,
+    since saved examples are shown to the model for other users' questions.
+    """
+    if len([s for s in sqlparse.split(sql_query) if s.strip()]) != 1:
+        raise ValueError("Only a single SQL statement can be saved.")
+    is_valid, message = validate_sql(get_engine(), sql_query)
+    if not is_valid:
+        raise ValueError(message)
+
+    try:
+        if not add_feedback_example(question, sql_query):
+            logger.info("Feedback example was already saved.")
+        return True
+    except Exception as e:
+        logger.exception(f"Could not save feedback example: {e}")
+        return False
+
+_SQL_START = re.compile(r'\b(?:SELECT|WITH)\b', re.IGNORECASE)
+
 def clean_sql_output(raw_output: str) -> str:
     """
     Cleans raw LLM output to extract a pure SQL query.
@@ -226,37 +384,50 @@ def clean_sql_output(raw_output: str) -> str:
         return ""
 
     # Find the start of the query (case-insensitive)
-    match = re.search(r'\b(SELECT|WITH)\b', raw_output, re.IGNORECASE)
+    match = _SQL_START.search(raw_output)
     
     if not match:
         return "" # No valid query start found
 
-    # Create a substring from the start of the query to the end
-    query_candidate = raw_output[match.start():]
+    # The match begins at the keyword, so there is no leading whitespace to strip
+    start = match.start()
     
-    # Find the position of the last semicolon
-    last_semicolon_pos = query_candidate.rfind(';')
+    # Find the position of the last semicolon after the start of the query
+    last_semicolon_pos = raw_output.rfind(';', start)
     
     if last_semicolon_pos != -1:
         # If a semicolon is found, trim the query to that point
-        final_query = query_candidate[:last_semicolon_pos + 1]
-    else:
-        # If no semicolon, assume the LLM forgot it and use the whole candidate string
-        final_query = query_candidate
-        
-    # Return the result with any remaining leading/trailing whitespace removed
-    return final_query.strip()
+        return raw_output[start:last_semicolon_pos + 1]
 
-def get_llm_analysis(user_question: str, df: pd.DataFrame, sql_query: str) -> str:
+    # If no semicolon, assume the LLM forgot it and use the rest of the output
+    return raw_output[start:].rstrip()
+
+# Caps on how much of a result set is pasted into the analysis prompt
+ANALYSIS_MAX_ROWS = 50
+ANALYSIS_MAX_COLUMNS = 20
+
+async def get_llm_analysis(user_question: str, df: pd.DataFrame, sql_query: str, total_rows: int | None = None) -> str:
     """
     Takes a dataframe and asks the LLM to provide a natural language analysis.
+    Only the first rows and columns are sent. Pass total_rows when df is
+    already a preview of a larger result.
     """
     if df.empty:
         return "The query returned no results. There is nothing to analyze."
 
-    # Convert the dataframe to a string format that's easy for the LLM to read.
-    # Markdown is often better than CSV for LLMs.
-    data_string = df.to_markdown(index=False)
+    if total_rows is None:
+        total_rows = len(df)
+
+    # Keep the prompt small: the LLM can't meaningfully summarize thousands of rows anyway
+    df_preview = df.head(ANALYSIS_MAX_ROWS)
+    if df_preview.shape[1] > ANALYSIS_MAX_COLUMNS:
+        df_preview = df_preview.iloc[:, :ANALYSIS_MAX_COLUMNS]
+
+    # CSV takes noticeably fewer tokens than a markdown table for the same data
+    data_string = df_preview.to_csv(index=False)
+    omitted_rows = total_rows - len(df_preview)
+    if omitted_rows > 0:
+        data_string += f"... ({omitted_rows} more rows omitted)\n"
 
     # Determine the prompt based on the result type (single vs. multi-value)
     if df.shape == (1, 1):
@@ -295,7 +466,7 @@ To answer this, the following SQL query was executed:
 {sql_query}
 It produced this result:
 
-Markdown
+CSV
 
 {data_string}
 Your Task:
@@ -305,4 +476,4 @@ Your Task:
     # Use your existing function to query the LLM
     # Note: You might want a different, more "creative" model for analysis
     # than the one you use for strict SQL generation.
-    return query_olama(analysis_prompt)
+    return await query_olama(analysis_prompt)
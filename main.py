@@ -1,20 +1,55 @@
 # main.py
+import asyncio
+import logging
+import os
+from collections.abc import Callable
+from contextlib import asynccontextmanager
+from functools import lru_cache
+
+import connectorx as cx
 import pandas as pd
+import pyarrow as pa
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
 from sqlalchemy import text
 
 # Our refactored modules
 from database import get_engine
 from schemas import QueryRequest, QueryResponse, FeedbackRequest
 import logic
+import prompt_logic
+import semantic_cache
+
+# --- Logging ---
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger(__name__)
 
 # --- App Initialization ---
+async def _warm_up_prompt_prefix():
+    """Loads the model in Olama with the static prompt prefix so the first query doesn't pay for it."""
+    try:
+        await prompt_logic.warm_up(_load_enhanced_schema())
+    except Exception as e:
+        logger.warning(f"Prompt prefix warm-up failed: {e}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Load (and on first run, download) the embedding model before serving requests
+    await run_in_threadpool(semantic_cache.get_embedding_model)
+    # Embed the few-shot examples now rather than on the first request
+    await run_in_threadpool(prompt_logic.preload_examples)
+    # Run in the background so startup isn't blocked on the LLM
+    warm_up = asyncio.create_task(_warm_up_prompt_prefix())
+    yield
+    warm_up.cancel()
+
 app = FastAPI(
     title="Chat with Your Database API",
     description="An API that converts natural language questions into SQL queries and insights.",
     version="1.0.0",
-    docs_url="/docs"
+    docs_url="/docs",
+    lifespan=lifespan
 )
 
 
@@ -38,6 +73,95 @@ app.add_middleware(
 # This ensures we use the same engine instance across the app
 engine = get_engine()
 
+# --- Semantic Cache ---
+# Maps previously answered questions to their validated SQL. Loaded from disk on startup.
+sql_cache = semantic_cache.SemanticCache()
+
+# --- Result Fetching ---
+RESULT_CHUNK_SIZE = 1000
+ANALYSIS_PREVIEW_ROWS = 100
+
+# connectorx takes a plain URL without the SQLAlchemy driver suffix (e.g. "+psycopg2").
+# Note: connectorx opens its own connection(s) per call from this URL, outside the
+# SQLAlchemy pool, so the pool settings in database.py don't apply to result fetches.
+CONNECTORX_URL = engine.url.set(drivername=engine.url.get_backend_name()).render_as_string(hide_password=False)
+
+# A fetched result: (preview of the first rows, total row count, converter to JSON records)
+FetchedResult = tuple[pd.DataFrame, int, Callable[[], list[dict]]]
+
+def _decimals_to_float(table: pa.Table) -> pa.Table:
+    """
+    Casts NUMERIC (decimal) columns to float64. Otherwise they come out as
+    Decimal and are serialized as strings, while pd.read_sql (coerce_float)
+    returns numbers.
+    """
+    schema = pa.schema([
+        pa.field(field.name, pa.float64(), field.nullable) if pa.types.is_decimal(field.type) else field
+        for field in table.schema
+    ])
+    return table if schema.equals(table.schema) else table.cast(schema)
+
+def _fetch_with_connectorx(sql: str) -> FetchedResult:
+    """Fetches the result as an Arrow table straight from the driver."""
+    # connectorx wraps the query in other statements, so it must not end with a semicolon
+    table = _decimals_to_float(cx.read_sql(CONNECTORX_URL, sql.strip().rstrip(';'), return_type="arrow"))
+    return table.slice(0, ANALYSIS_PREVIEW_ROWS).to_pandas(), table.num_rows, table.to_pylist
+
+def _fetch_with_sqlalchemy(sql: str) -> FetchedResult:
+    """Fetches the result in chunks through a server-side cursor."""
+    data_as_json = []
+    preview_df = None
+    with engine.connect().execution_options(stream_results=True) as connection:
+        for chunk in pd.read_sql(text(sql), connection, chunksize=RESULT_CHUNK_SIZE):
+            if preview_df is None:
+                preview_df = chunk.head(ANALYSIS_PREVIEW_ROWS)
+            data_as_json.extend(chunk.to_dict(orient='records'))
+    if preview_df is None:
+        preview_df = pd.DataFrame()
+    return preview_df, len(data_as_json), lambda: data_as_json
+
+def _is_rust_panic(e: BaseException) -> bool:
+    """
+    True for pyo3_runtime.PanicException, raised when connectorx hits an
+    unimplemented conversion. pyo3 doesn't expose the class for import.
+    """
+    return type(e).__module__ == "pyo3_runtime" and type(e).__name__ == "PanicException"
+
+def fetch_results(sql: str) -> FetchedResult:
+    """
+    Executes the query. Returns a preview DataFrame of the first rows for the
+    LLM analysis, the total row count, and a callable that produces all rows
+    as JSON records (deferred so it can overlap with the analysis).
+    """
+    try:
+        return _fetch_with_connectorx(sql)
+    except RuntimeError as e:
+        # connectorx raises its own errors as RuntimeError. Errors from the database itself
+        # ("db error: ...") would fail through SQLAlchemy too, so only fall back for the rest,
+        # e.g. a column type connectorx can't map.
+        if "db error" in str(e):
+            raise
+        logger.warning(f"connectorx fetch failed, falling back to SQLAlchemy: {e}")
+    except BaseException as e:
+        # PanicException derives from BaseException; anything else is re-raised untouched
+        if not _is_rust_panic(e):
+            raise
+        logger.warning(f"connectorx panicked, falling back to SQLAlchemy: {e}")
+    return _fetch_with_sqlalchemy(sql)
+
+# --- Enhanced Schema ---
+ENHANCED_SCHEMA_PATH = "schema_documentation.md"
+
+@lru_cache(maxsize=1)
+def _read_enhanced_schema(mtime: float) -> str:
+    """Reads the schema documentation. Cached per file modification time."""
+    with open(ENHANCED_SCHEMA_PATH, "r") as f:
+        return f.read()
+
+def _load_enhanced_schema() -> str:
+    """Returns the schema documentation, re-reading it only when the file changes."""
+    return _read_enhanced_schema(os.path.getmtime(ENHANCED_SCHEMA_PATH))
+
 # --- API Endpoints ---
 @app.get("/")
 def read_root():
@@ -65,32 +189,60 @@ async def handle_query(request: QueryRequest):
     Main endpoint to process a user's question.
     """
     try:
-        # Load enhanced schema from file (could be cached)
-        with open("schema_documentation.md", "r") as f:
-            enhanced_schema = f.read()
+        # Load enhanced schema (cached until the file changes)
+        enhanced_schema = _load_enhanced_schema()
 
-        # 1. Generate and Validate SQL
-        final_sql = logic.generate_and_validate_sql(
-            user_question=request.question,
-            enhanced_schema=enhanced_schema,
-            engine=engine,
-            previous_sql=request.previous_sql,
-            user_feedback=request.feedback
-        )
+        # 1. Look for a previously validated query for the same (or a paraphrased) question.
+        # Refinement requests skip the cache, since the user rejected the earlier answer,
+        # and their result replaces the rejected one below.
+        is_refinement = bool(request.previous_sql and request.feedback)
+        schema_fingerprint = semantic_cache.schema_hash(enhanced_schema)
+        question_embedding = await run_in_threadpool(semantic_cache.embed, request.question)
+
+        final_sql = None
+        if not is_refinement:
+            cached_sql = await run_in_threadpool(
+                sql_cache.lookup, request.question, question_embedding, schema_fingerprint
+            )
+            if cached_sql:
+                # The database may have changed since the query was cached, so re-validate it
+                is_valid, _ = await run_in_threadpool(logic.validate_sql, engine, cached_sql)
+                if is_valid:
+                    logger.info("Semantic cache hit. Skipping SQL generation.")
+                    final_sql = cached_sql
 
-        # 2. Execute the SQL Query
-        with engine.connect() as connection:
-            df = pd.read_sql(text(final_sql), connection)
+        # 2. Generate and Validate SQL on a cache miss
+        if final_sql is None:
+            final_sql = await logic.generate_and_validate_sql(
+                user_question=request.question,
+                enhanced_schema=enhanced_schema,
+                engine=engine,
+                previous_sql=request.previous_sql,
+                user_feedback=request.feedback
+            )
+            await run_in_threadpool(
+                sql_cache.insert, request.question, question_embedding, final_sql, schema_fingerprint,
+                request.previous_sql if is_refinement else None
+            )
 
-        # 3. Get LLM Analysis of the results
-        llm_summary = logic.get_llm_analysis(
+        # 3. Execute the SQL Query
+        preview_df, total_rows, to_records = await run_in_threadpool(fetch_results, final_sql)
+
+        # 4. Start the LLM Analysis of the results. The LLM only sees the first rows.
+        llm_task = asyncio.create_task(logic.get_llm_analysis(
             user_question=request.question,
-            df=df,
-            sql_query=final_sql
-        )
-        
-        # 4. Format the DataFrame for JSON response
-        data_as_json = df.to_dict(orient='records')
+            df=preview_df,
+            sql_query=final_sql,
+            total_rows=total_rows
+        ))
+
+        # 5. Format the rows for the JSON response in a worker thread while the LLM runs
+        try:
+            data_as_json = await asyncio.get_running_loop().run_in_executor(None, to_records)
+        except Exception:
+            llm_task.cancel()
+            raise
+        llm_summary = await llm_task
 
         return QueryResponse(
             analysis=llm_summary,
@@ -112,7 +264,11 @@ async def handle_feedback(request: FeedbackRequest):
     Endpoint to save a query that the user marked as helpful.
     """
     if request.is_good:
-        success = logic.save_good_example(request.question, request.sql_query)
+        try:
+            # Validates the SQL with EXPLAIN and embeds the question, so keep it off the event loop
+            success = await run_in_threadpool(logic.save_good_example, request.question, request.sql_query)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid SQL: {e}")
         if success:
             return {"status": "success", "message": "Example saved successfully."}
         else:
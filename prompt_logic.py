@@ -1,40 +1,34 @@
+import asyncio
+import logging
 import ollama
-import random
-import streamlit as st # Used for st.info and st.code in the placeholder
+import numpy as np
+from contextlib import aclosing
 from pathlib import Path
+from functools import lru_cache
 
+from semantic_cache import ExampleIndex, embed, embed_many
 
-def build_prompt_from_files(schema_string, examples_file, user_question, num_examples=3):
-    """
-    Builds a few-shot prompt by randomly selecting a specified
-    number of examples from the examples file.
-    """
-    examples_file = Path(examples_file)
+logger = logging.getLogger(__name__)
 
-    with examples_file.open('r', encoding="utf-8") as f:
-        examples_raw = f.read()
+EXAMPLES_FILE = Path("prompt_components/examples.txt")
 
-    # Parse all examples into a list
-    all_examples = examples_raw.strip().split('###')
-    all_examples = [ex.strip() for ex in all_examples if ex.strip()]
+OLAMA_MODEL = 'llama3:8b' # Or whichever model you are using
+OLAMA_OPTIONS = {
+    'temperature': 0,
+    'seed': 42,
+    # Keep the whole prompt in context so the cached prefix is never shifted out
+    'num_keep': -1
+}
 
-    # Randomly select a subset of examples
-    if len(all_examples) > num_examples:
-        selected_examples = random.sample(all_examples, num_examples)
-    else:
-        selected_examples = all_examples
 
-    # Format the selected examples
-    formatted_examples = ""
-    for i, block in enumerate(selected_examples):
-        parts = block.strip().split('---')
-        question = parts[0].strip()
-        query = parts[1].strip()
-        
-        formatted_examples += f"### Example {i+1}:\n\n**{question}**\n\n**{query}**\n\n"
-
-    # Assemble the final prompt
-    prompt = f""""  You are an expert PostgreSQL data analyst and query optimization specialist. Your sole purpose is to convert a business question into a single, high-performance, and syntactically correct PostgreSQL query based on the provided schema and rules.
+@lru_cache(maxsize=8)
+def build_prompt_prefix(schema_string):
+    """
+    Builds the static part of the prompt (directives and schema).
+    It only changes when the schema does, so the inference server
+    can reuse its KV cache for this prefix across requests.
+    """
+    return f""""  You are an expert PostgreSQL data analyst and query optimization specialist. Your sole purpose is to convert a business question into a single, high-performance, and syntactically correct PostgreSQL query based on the provided schema and rules.
 
 ---
 ### ## Core Directives
@@ -69,7 +63,88 @@ def build_prompt_from_files(schema_string, examples_file, user_question, num_exa
 ### Database Schema:
 {schema_string}
 ---
-{formatted_examples}
+"""
+
+
+@lru_cache(maxsize=4)
+def _parse_examples(path: str, mtime: float) -> tuple[tuple[str, str], ...]:
+    """Parses the examples file into (question, query) pairs. Cached per file modification time."""
+    with Path(path).open('r', encoding="utf-8") as f:
+        examples_raw = f.read()
+
+    examples = []
+    for block in examples_raw.strip().split('###'):
+        if not block.strip():
+            continue
+        parts = block.strip().split('---')
+        examples.append((parts[0].strip(), parts[1].strip()))
+    return tuple(examples)
+
+
+def _load_examples(path: str) -> tuple[tuple[str, str], ...]:
+    """Returns the parsed examples, re-reading the file only when it changes."""
+    return _parse_examples(path, Path(path).stat().st_mtime)
+
+
+@lru_cache(maxsize=4)
+def _embed_examples(examples: tuple[tuple[str, str], ...]) -> np.ndarray:
+    """Embeds the question of every example into an (N, 384) matrix. Cached per examples set."""
+    questions = [question.removeprefix("User Question:").strip() for question, _ in examples]
+    return embed_many(questions)
+
+
+def preload_examples(examples_file=EXAMPLES_FILE):
+    """Parses and embeds the examples file ahead of time, so the first request doesn't have to."""
+    _embed_examples(_load_examples(str(examples_file)))
+
+
+# Question/SQL pairs users marked as helpful, persisted alongside the semantic cache
+feedback_examples = ExampleIndex()
+# Added to the similarity of feedback examples so they win over equally similar built-in ones
+FEEDBACK_BOOST = 0.05
+
+
+def add_feedback_example(question, sql_query):
+    """Stores a user-approved question/SQL pair for example retrieval. Returns False if it was already stored."""
+    return feedback_examples.insert(question, embed(question), sql_query, source='feedback')
+
+
+def _select_examples(examples, question, num_examples):
+    """
+    Returns the examples whose questions are most similar to the given question,
+    drawing from both the examples file and the feedback examples.
+    """
+    feedback_entries, feedback_vectors = feedback_examples.snapshot()
+    candidates = list(examples) + [(f"User Question: {q}", sql) for q, sql, _ in feedback_entries]
+    if len(candidates) <= num_examples:
+        return candidates
+
+    # Embeddings are normalized, so the dot product is the cosine similarity
+    question_vector = embed(question)
+    scores = np.concatenate([_embed_examples(examples) @ question_vector, feedback_vectors @ question_vector])
+    scores[len(examples):] += FEEDBACK_BOOST
+    top = np.argpartition(scores, -num_examples)[-num_examples:]
+    # Keep a fixed order so the same set of examples always renders identically
+    return [candidates[i] for i in sorted(top)]
+
+
+def build_prompt_suffix(examples_file, user_question, num_examples=3, retrieval_question=None):
+    """
+    Builds the per-request part of the prompt: the examples most similar
+    to the question, followed by the user question.
+    Examples are retrieved by retrieval_question when given, otherwise by user_question.
+    """
+    all_examples = _load_examples(str(examples_file))
+
+    selected_examples = _select_examples(all_examples, retrieval_question or user_question, num_examples)
+
+    # Format the selected examples
+    example_parts: list[str] = []
+    for i, (question, query) in enumerate(selected_examples):
+        example_parts.append(f"### Example {i+1}:\n\n**{question}**\n\n**{query}**\n\n")
+    formatted_examples = "".join(example_parts)
+
+    return f"""{formatted_examples}
 ---
 
 ### New Task:
@@ -77,24 +152,85 @@ def build_prompt_from_files(schema_string, examples_file, user_question, num_exa
 
 **SQL Query:**
 """
-    return prompt
 
-def query_olama(prompt):
-    """Sends the prompt to a running Olama instance and gets a response."""
-    st.info("Sending prompt to Olama...")
-    # st.code(prompt, language='text') # Optional: you can hide the full prompt
+
+def build_prompt_from_files(schema_string, examples_file, user_question, num_examples=3, retrieval_question=None):
+    """
+    Builds a few-shot prompt. The static directives and schema come first,
+    followed by the examples most similar to the question, with the user question last.
+    """
+    return build_prompt_prefix(schema_string) + build_prompt_suffix(
+        examples_file, user_question, num_examples, retrieval_question
+    )
+
+
+async def warm_up(schema_string):
+    """
+    Sends the static prompt prefix once (generating a single token) so Olama
+    loads the model and has the prefix in its KV cache before the first
+    query. Requests always send the full prompt; Olama reuses the cached
+    prefix on its own when a new prompt starts with the same text.
+    """
+    await _get_client().generate(
+        model=OLAMA_MODEL,
+        prompt=build_prompt_prefix(schema_string),
+        options={**OLAMA_OPTIONS, 'num_predict': 1}
+    )
+
+
+async def prepare_sql_prompt(schema_string, examples_file, user_question, num_examples=3, retrieval_question=None):
+    """
+    Returns the full prompt for SQL generation: the static prefix followed by
+    examples and the question. Built in a worker thread, since retrieving the
+    examples embeds text and may re-embed an edited examples file.
+    """
+    return await asyncio.to_thread(
+        build_prompt_from_files, schema_string, examples_file, user_question, num_examples, retrieval_question
+    )
+
+_client: ollama.AsyncClient | None = None
+
+def _get_client() -> ollama.AsyncClient:
+    """Returns the shared async Olama client, creating it on first use."""
+    global _client
+    if _client is None:
+        _client = ollama.AsyncClient()
+    return _client
+
+
+async def query_olama(prompt, stop_when=None):
+    """
+    Streams a response for the prompt from a running Olama instance.
+
+    If stop_when is given, it is an async callable awaited with the output up
+    to each completed statement (a semicolon followed by a newline). When it
+    returns True the stream is closed, which stops generation, and that output
+    is returned.
+    """
+    output = ""
+    checked_upto = -1
 
     try:
         # Make the actual API call to Olama
-        response = ollama.generate(
-            model='llama3:8b', # Or whichever model you are using
+        stream = await _get_client().generate(
+            model=OLAMA_MODEL,
             prompt=prompt,
-            options={
-            'temperature': 0,
-            'seed': 42
-        }
+            stream=True,
+            options=OLAMA_OPTIONS
         )
-        return response['response'].strip()
+        # Closing the stream drops the connection, which makes Olama stop generating
+        async with aclosing(stream):
+            async for chunk in stream:
+                output += chunk['response']
+                if stop_when is None:
+                    continue
+
+                last_semicolon_pos = output.rfind(';')
+                if last_semicolon_pos > checked_upto and '\n' in output[last_semicolon_pos:]:
+                    checked_upto = last_semicolon_pos
+                    if await stop_when(output[:last_semicolon_pos + 1]):
+                        return output[:last_semicolon_pos + 1].strip()
+        return output.strip()
     except Exception as e:
-        st.error(f"Error communicating with Olama: {e}")
-        return None
\ No newline at end of file
+        logger.exception(f"Error communicating with Olama: {e}")
+        return None
@@ -0,0 +1,266 @@
+# semantic_cache.py
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
+from pathlib import Path
+
+import faiss
+import numpy as np
+from filelock import FileLock
+from sentence_transformers import SentenceTransformer
+
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+EMBEDDING_DIM = 384
+SIMILARITY_THRESHOLD = 0.92
+# Neighbours considered per lookup, so entries for an older schema can't shadow a current one
+LOOKUP_TOP_K = 10
+CACHE_DIR = Path("cache")
+
+# Numbers, quoted values, quarters, month names and number words in a question.
+# Paraphrases that differ only in one of these ("Feb 2025" vs "Mar 2025") still
+# embed very closely, but need different SQL.
+_MONTHS = [
+    "january", "february", "march", "april", "may", "june",
+    "july", "august", "september", "october", "november", "december",
+]
+_MONTH_PREFIXES = {month[:3] for month in _MONTHS}
+_NUMBER_WORDS = [
+    "one", "two", "three", "four", "five", "six", "seven", "eight", "nine", "ten",
+    "eleven", "twelve", "twenty", "fifty", "hundred",
+]
+_LITERAL = re.compile(
+    r"\d+(?:[.,:/-]\d+)*|'[^']*'|\"[^\"]*\"|\bq[1-4]\b|\b(?:"
+    + "|".join(_MONTHS + sorted(_MONTH_PREFIXES) + ["sept"] + _NUMBER_WORDS)
+    + r")\b",
+    re.IGNORECASE
+)
+
+
+@lru_cache(maxsize=1)
+def get_embedding_model() -> SentenceTransformer:
+    """Loads the sentence-transformers model once and reuses it."""
+    return SentenceTransformer(EMBEDDING_MODEL)
+
+
+@lru_cache(maxsize=256)
+def embed(text: str) -> np.ndarray:
+    """
+    Embeds a piece of text into a normalized float32 vector, so that an
+    inner product between two embeddings is their cosine similarity.
+    Results are cached and returned read-only, since they are shared.
+    """
+    vector = get_embedding_model().encode(text, normalize_embeddings=True)
+    vector = np.asarray(vector, dtype=np.float32)
+    vector.flags.writeable = False
+    return vector
+
+
+def embed_many(texts: list[str]) -> np.ndarray:
+    """Embeds several texts at once into an (N, EMBEDDING_DIM) float32 matrix."""
+    if not texts:
+        return np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+    vectors = get_embedding_model().encode(texts, normalize_embeddings=True)
+    return np.asarray(vectors, dtype=np.float32)
+
+
+def _as_row(vector: np.ndarray) -> np.ndarray:
+    """Returns a writable (1, EMBEDDING_DIM) copy of an embedding for FAISS."""
+    return np.array(vector, dtype=np.float32).reshape(1, -1)
+
+
+def question_literals(question: str) -> list[str]:
+    """Returns the numbers, dates and quoted values in a question, normalized for comparison."""
+    literals = []
+    for match in _LITERAL.finditer(question.lower()):
+        value = match.group()
+        # "february" and "feb" are the same month
+        literals.append(value[:3] if value[:3] in _MONTH_PREFIXES else value)
+    return sorted(literals)
+
+
+def schema_hash(schema: str) -> str:
+    """Returns a short fingerprint of the schema text a query was generated against."""
+    return hashlib.sha256(schema.encode("utf-8")).hexdigest()[:16]
+
+
+class _PersistentIndex:
+    """
+    A FAISS inner-product index with a parallel list of metadata tuples.
+    Both are persisted under CACHE_DIR and loaded again on startup.
+
+    Several worker processes may share the files. Writes hold a file lock
+    and start from the latest copy on disk, and reads pick up files written
+    by other processes, so no worker overwrites another's entries.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.index_path = CACHE_DIR / f"{name}.faiss"
+        self.meta_path = CACHE_DIR / f"{name}.json"
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        self._file_lock = FileLock(str(CACHE_DIR / f"{name}.lock"))
+        self._lock = threading.Lock()
+        self._disk_version = None
+        with self._file_lock:
+            self._load()
+
+    def _stat_version(self):
+        """Identifies the metadata file on disk. It is replaced on every save, so this changes too."""
+        try:
+            stat = self.meta_path.stat()
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _load(self):
+        """Loads the index from disk. Must be called with the file lock held."""
+        self._disk_version = self._stat_version()
+        if self.index_path.exists() and self.meta_path.exists():
+            try:
+                self.index = faiss.read_index(str(self.index_path))
+                with self.meta_path.open("r", encoding="utf-8") as f:
+                    self.entries = [tuple(entry) for entry in json.load(f)]
+                if self.index.ntotal == len(self.entries):
+                    return
+                logger.warning(f"{self.name} index and metadata are out of sync. Starting empty.")
+            except Exception as e:
+                logger.warning(f"Could not load {self.name} from disk: {e}")
+        self.index = faiss.IndexFlatIP(EMBEDDING_DIM)
+        self.entries: list[tuple] = []
+
+    def _reload_if_changed(self):
+        """Reloads the index if another process saved it. Must be called with the file lock held."""
+        if self._stat_version() != self._disk_version:
+            self._load()
+
+    @contextmanager
+    def _reading(self):
+        """Holds the thread lock, first picking up changes saved by other processes."""
+        with self._lock:
+            if self._stat_version() != self._disk_version:
+                with self._file_lock:
+                    self._reload_if_changed()
+            yield
+
+    @contextmanager
+    def _writing(self):
+        """Holds the thread and file locks, starting from the latest copy on disk."""
+        with self._lock, self._file_lock:
+            self._reload_if_changed()
+            yield
+
+    def _save(self):
+        """Persists the index. Must be called with the file lock held."""
+        # Write to temporary files first so a crash never leaves a half-written cache.
+        # The names are per process, so workers never write into each other's files.
+        tmp_index = self.index_path.with_suffix(f".faiss.{os.getpid()}.tmp")
+        tmp_meta = self.meta_path.with_suffix(f".json.{os.getpid()}.tmp")
+        faiss.write_index(self.index, str(tmp_index))
+        with tmp_meta.open("w", encoding="utf-8") as f:
+            json.dump(self.entries, f)
+        tmp_index.replace(self.index_path)
+        tmp_meta.replace(self.meta_path)
+        self._disk_version = self._stat_version()
+
+    def _add(self, embedding: np.ndarray, entry: tuple, remove: list[int] = ()):
+        """
+        Adds one entry and persists the index. Entries at the indices in
+        remove are dropped first. Must be called inside _writing().
+        """
+        if remove:
+            # IndexFlat compacts the remaining ids in order, keeping them aligned with the list
+            self.index.remove_ids(np.array(sorted(remove), dtype=np.int64))
+            for idx in sorted(remove, reverse=True):
+                del self.entries[idx]
+        self.index.add(_as_row(embedding))
+        self.entries.append(entry)
+        try:
+            self._save()
+        except Exception as e:
+            # The in-memory index is still usable, so we only log the failure
+            logger.warning(f"Could not persist {self.name}: {e}")
+
+
+class SemanticCache(_PersistentIndex):
+    """
+    Maps question embeddings to previously validated SQL.
+    Entries are (question, sql, schema_hash) tuples.
+    """
+
+    def __init__(self, name: str = "semantic_cache", threshold: float = SIMILARITY_THRESHOLD):
+        self.threshold = threshold
+        super().__init__(name)
+
+    def lookup(self, question: str, question_embedding: np.ndarray, schema_fingerprint: str) -> str | None:
+        """
+        Returns the cached SQL for the closest question with the same schema
+        and the same numbers and dates, or None on a miss.
+        """
+        literals = question_literals(question)
+        with self._reading():
+            if self.index.ntotal == 0:
+                return None
+            k = min(LOOKUP_TOP_K, self.index.ntotal)
+            scores, ids = self.index.search(_as_row(question_embedding), k)
+            # Results are sorted by similarity, so the first match is the best one
+            for score, idx in zip(scores[0], ids[0]):
+                if idx < 0 or score <= self.threshold:
+                    break
+                cached_question, sql, cached_schema = self.entries[idx]
+                if cached_schema == schema_fingerprint and question_literals(cached_question) == literals:
+                    return sql
+            return None
+
+    def insert(self, question: str, question_embedding: np.ndarray, sql: str, schema_fingerprint: str,
+               rejected_sql: str | None = None):
+        """
+        Adds a validated question/SQL pair and persists the cache. An existing
+        entry for the same question (e.g. from an older schema) is replaced, as
+        is every entry answered with rejected_sql, the SQL a refinement replaces.
+        """
+        with self._writing():
+            remove = [
+                i for i, (cached_question, cached_sql, _) in enumerate(self.entries)
+                if cached_question == question or (rejected_sql is not None and cached_sql == rejected_sql)
+            ]
+            self._add(question_embedding, (question, sql, schema_fingerprint), remove)
+
+
+class ExampleIndex(_PersistentIndex):
+    """
+    Few-shot examples added at runtime, retrievable by question embedding.
+    Entries are (question, sql, source) tuples.
+    """
+
+    def __init__(self, name: str = "feedback_examples"):
+        self._snapshot = None
+        super().__init__(name)
+
+    def _load(self):
+        super()._load()
+        self._snapshot = None
+
+    def insert(self, question: str, question_embedding: np.ndarray, sql: str, source: str) -> bool:
+        """Adds an example and persists the index. Returns False if it was already stored."""
+        with self._writing():
+            if any(entry[0] == question and entry[1] == sql for entry in self.entries):
+                return False
+            self._add(question_embedding, (question, sql, source))
+            self._snapshot = None
+            return True
+
+    def snapshot(self) -> tuple[list[tuple], np.ndarray]:
+        """Returns the entries and their (N, EMBEDDING_DIM) embedding matrix. Cached until the index changes."""
+        with self._reading():
+            if self._snapshot is None:
+                if self.index.ntotal:
+                    vectors = self.index.reconstruct_n(0, self.index.ntotal)
+                else:
+                    vectors = np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+                self._snapshot = (list(self.entries), vectors)
+            return self._snapshot
@@ -0,0 +1,103 @@
+# sql_fixes.py
+import re
+
+# `identifier` -> "identifier"
+_BACKTICK = re.compile(r'`([^`]+)`')
+# NOW() -> CURRENT_TIMESTAMP
+_NOW = re.compile(r'\bNOW\(\s*\)', re.IGNORECASE)
+
+# String literals, calls to the functions we rewrite, and the parens/commas around their arguments
+_TOKEN = re.compile(
+    r"""'[^']*'|"[^"]*"|\b(IFNULL|DATE|ROUND|FORMAT_DATE)\s*\(|[(),]""", re.IGNORECASE
+)
+_NUMERIC_CAST = re.compile(r'^CAST\s*\(.*\bAS\s+NUMERIC\s*\)$', re.IGNORECASE | re.DOTALL)
+
+
+class _Call:
+    """A call whose closing paren hasn't been reached yet."""
+
+    def __init__(self, name: str, opening: str):
+        self.name = name
+        self.opening = opening  # e.g. "ROUND(" as written
+        self.args: list[str] = []
+        self.current: list[str] = []  # pieces of the argument being read
+        self.depth = 0  # plain parens open inside the current argument
+
+    def end_arg(self):
+        self.args.append("".join(self.current))
+        self.current = []
+
+    def as_written(self) -> str:
+        """The call with its (already rewritten) arguments, without the closing paren."""
+        return self.opening + ",".join(self.args)
+
+
+def _rewrite_call(name: str, args: list[str]) -> str | None:
+    """Returns the PostgreSQL form of a call, or None to leave it unchanged."""
+    # IFNULL(a, b) -> COALESCE(a, b)
+    if name == 'IFNULL' and len(args) == 2:
+        return f"COALESCE({args[0]}, {args[1]})"
+    # DATE(col) -> CAST(col AS DATE)
+    if name == 'DATE' and len(args) == 1 and args[0]:
+        return f"CAST({args[0]} AS DATE)"
+    # ROUND(col, n) -> ROUND(CAST(col AS NUMERIC), n)
+    if name == 'ROUND' and len(args) == 2 and not _NUMERIC_CAST.match(args[0]):
+        return f"ROUND(CAST({args[0]} AS NUMERIC), {args[1]})"
+    # FORMAT_DATE('%B', col) -> TO_CHAR(col, 'Month')
+    if name == 'FORMAT_DATE' and len(args) == 2 and args[0] == "'%B'":
+        return f"TO_CHAR({args[1]}, 'Month')"
+    return None
+
+
+def _rewrite_calls(sql: str) -> str:
+    """
+    Rewrites MySQL-style function calls, including calls nested in their
+    arguments, in a single pass. Inner calls are rewritten as they close, so
+    nothing is scanned twice. Calls that are never closed are left as written.
+    """
+    output: list[str] = []
+    stack: list[_Call] = []
+
+    def emit(text: str):
+        (stack[-1].current if stack else output).append(text)
+
+    pos = 0
+    for token in _TOKEN.finditer(sql):
+        emit(sql[pos:token.start()])
+        pos = token.end()
+        value = token.group()
+        call = stack[-1] if stack else None
+
+        if token.group(1) is not None:
+            stack.append(_Call(token.group(1).upper(), value))
+        elif call is None or value[0] in "'\"":
+            emit(value)
+        elif value == '(':
+            call.depth += 1
+            emit(value)
+        elif value == ',' and call.depth == 0:
+            call.end_arg()
+        elif value == ')' and call.depth == 0:
+            call.end_arg()
+            stack.pop()
+            rewritten = _rewrite_call(call.name, [arg.strip() for arg in call.args])
+            emit(rewritten if rewritten is not None else call.as_written() + ")")
+        else:
+            if value == ')':
+                call.depth -= 1
+            emit(value)
+    emit(sql[pos:])
+
+    # Unbalanced input: keep the unclosed calls as written
+    while stack:
+        call = stack.pop()
+        call.end_arg()
+        emit(call.as_written())
+    return "".join(output)
+
+
+def apply_postgres_fixes(sql: str) -> str:
+    """Fixes common MySQL-style SQL issues for PostgreSQL."""
+    sql = _BACKTICK.sub(r'"\1"', sql)
+    sql = _NOW.sub('CURRENT_TIMESTAMP', sql)
+    return _rewrite_calls(sql).strip()
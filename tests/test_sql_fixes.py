@@ -0,0 +1,78 @@
+import time
+import unittest
+
+from sql_fixes import apply_postgres_fixes
+
+
+class ApplyPostgresFixesTest(unittest.TestCase):
+
+    def test_simple_rewrites(self):
+        self.assertEqual(
+            apply_postgres_fixes("SELECT `a`, IFNULL(x, 0) FROM t WHERE d < NOW()"),
+            'SELECT "a", COALESCE(x, 0) FROM t WHERE d < CURRENT_TIMESTAMP',
+        )
+        self.assertEqual(
+            apply_postgres_fixes("SELECT FORMAT_DATE('%B', order_date) FROM t WHERE DATE(order_date) >= '2025-01-01'"),
+            "SELECT TO_CHAR(order_date, 'Month') FROM t WHERE CAST(order_date AS DATE) >= '2025-01-01'",
+        )
+
+    def test_round_with_nested_commas(self):
+        self.assertEqual(
+            apply_postgres_fixes("SELECT ROUND(SUM(a)*100.0/NULLIF(SUM(b), 0), 2) FROM t"),
+            "SELECT ROUND(CAST(SUM(a)*100.0/NULLIF(SUM(b), 0) AS NUMERIC), 2) FROM t",
+        )
+        self.assertEqual(
+            apply_postgres_fixes("SELECT ROUND(COALESCE(SUM(x), 0), 2) FROM t"),
+            "SELECT ROUND(CAST(COALESCE(SUM(x), 0) AS NUMERIC), 2) FROM t",
+        )
+
+    def test_date_with_nested_call(self):
+        self.assertEqual(
+            apply_postgres_fixes("SELECT DATE(DATE_TRUNC('month', d)) FROM t"),
+            "SELECT CAST(DATE_TRUNC('month', d) AS DATE) FROM t",
+        )
+
+    def test_nested_rewrites(self):
+        self.assertEqual(
+            apply_postgres_fixes("SELECT ROUND(IFNULL(SUM(x), 0), 2) FROM t"),
+            "SELECT ROUND(CAST(COALESCE(SUM(x), 0) AS NUMERIC), 2) FROM t",
+        )
+
+    def test_multiline_percentage_idiom(self):
+        sql = "SELECT ROUND(\n  (SUM(o.sales_revenue) * 100.0) /\n  SUM(SUM(o.sales_revenue)) OVER(), 2\n  ) AS share FROM o"
+        self.assertEqual(
+            apply_postgres_fixes(sql),
+            "SELECT ROUND(CAST((SUM(o.sales_revenue) * 100.0) /\n  SUM(SUM(o.sales_revenue)) OVER() AS NUMERIC), 2) AS share FROM o",
+        )
+
+    def test_leaves_postgres_sql_alone(self):
+        for sql in [
+            "SELECT ROUND(CAST(x AS NUMERIC), 2) FROM t",
+            "SELECT ROUND(x) FROM t",
+            "SELECT TO_DATE(x, 'YYYY'), CURRENT_DATE, UPDATE_DATE(x) FROM t",
+            "SELECT 'DATE(x), ROUND(y, 2)' AS label FROM t",
+            "SELECT ROUND(SUM(a), 2 FROM t",
+        ]:
+            self.assertEqual(apply_postgres_fixes(sql), sql)
+
+    def test_declined_calls_keep_rewritten_arguments(self):
+        self.assertEqual(
+            apply_postgres_fixes("SELECT ROUND(ROUND(IFNULL(x, 0))), DATE(a, DATE(b)) FROM t"),
+            "SELECT ROUND(ROUND(COALESCE(x, 0))), DATE(a, CAST(b AS DATE)) FROM t",
+        )
+
+    def test_deeply_nested_calls_are_linear(self):
+        sql = "SELECT " + "ROUND(" * 2000 + "x" + ")" * 2000 + " FROM t"
+        start = time.perf_counter()
+        self.assertEqual(apply_postgres_fixes(sql), sql)
+        self.assertLess(time.perf_counter() - start, 1.0)
+
+    def test_unbalanced_input_is_linear(self):
+        sql = "SELECT " + "IFNULL((" * 8000
+        start = time.perf_counter()
+        self.assertEqual(apply_postgres_fixes(sql), sql)
+        self.assertLess(time.perf_counter() - start, 1.0)
+
+
+if __name__ == "__main__":
+    unittest.main()